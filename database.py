@@ -1,11 +1,76 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey
+import aiosqlite
+from sqlalchemy import create_engine, event, Column, Integer, String, Float, ForeignKey, Index
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.schema import CreateIndex
 
-DATABASE_URL = "sqlite:///./stocks.db"
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+DATABASE_PATH = "./stocks.db"
+DATABASE_URL = f"sqlite:///{DATABASE_PATH}"
+ASYNC_DATABASE_URL = f"sqlite+aiosqlite:///{DATABASE_PATH}"
+QUERY_CACHE_SIZE = 1200  # Compiled select() statements kept per engine
+
+# Tune every new SQLite connection: WAL lets readers and the writer run concurrently
+# and synchronous=NORMAL turns each commit into a WAL append instead of a full fsync
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-1048576",  # 1GB page cache
+    "PRAGMA mmap_size=268435456",  # 256MB memory-mapped I/O
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA foreign_keys=ON",
+)
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+# SQLite allows a single writer, so registrations and the price scheduler share one
+# pooled connection (balance and quantity changes use the trade connection below) while
+# reads fan out over a separate pool that WAL lets run alongside the writer.
+# Both run on aiosqlite so request handlers never block the event loop.
+write_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=1,
+    max_overflow=0,
+    query_cache_size=QUERY_CACHE_SIZE,
+)
+read_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=8,
+    max_overflow=4,
+    query_cache_size=QUERY_CACHE_SIZE,
+)
+event.listen(write_engine.sync_engine, "connect", set_sqlite_pragmas)
+event.listen(read_engine.sync_engine, "connect", set_sqlite_pragmas)
+
+WriteSession = async_sessionmaker(bind=write_engine, autoflush=False, expire_on_commit=False, class_=AsyncSession)
+ReadSession = async_sessionmaker(bind=read_engine, autoflush=False, expire_on_commit=False, class_=AsyncSession)
+
+# The startup trading simulation runs before the event loop starts, so it keeps a
+# synchronous engine, which also creates the schema
+engine = create_engine(
+    DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    query_cache_size=QUERY_CACHE_SIZE,
+)
+event.listen(engine, "connect", set_sqlite_pragmas)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# The trade endpoints bypass the ORM and run their statements on one raw connection in
+# autocommit mode, managing BEGIN IMMEDIATE / COMMIT themselves
+async def connect_trade_db():
+    conn = await aiosqlite.connect(DATABASE_PATH, isolation_level=None)
+    for pragma in SQLITE_PRAGMAS:
+        await conn.execute(pragma)
+    return conn
 Base = declarative_base()
 
 class User(Base):
@@ -19,7 +84,7 @@ class Stock(Base):
     __tablename__ = "stocks"
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, unique=True, index=True)
-    price = Column(Float)
+    price = Column(Integer)  # In cents; divided by 100 when read out
     available_quantity = Column(Integer)
 
 class Transaction(Base):
@@ -31,4 +96,37 @@ class Transaction(Base):
     price = Column(Float)
     type = Column(String)  # "buy" or "sell"
 
-Base.metadata.create_all(bind=engine)
+# Descending indexes so the top-5 leaderboards read the first rows of an index
+# instead of sorting the whole table
+ix_users_balance_desc = Index("ix_users_balance_desc", User.balance.desc())
+ix_stocks_price_desc = Index("ix_stocks_price_desc", Stock.price.desc())
+
+# create_all checks for each table before creating it, so run it under the write lock;
+# otherwise workers starting together race on the same CREATE TABLE
+with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+    conn.exec_driver_sql("BEGIN IMMEDIATE")
+    try:
+        Base.metadata.create_all(bind=conn)
+        conn.exec_driver_sql("COMMIT")
+    except Exception:
+        conn.exec_driver_sql("ROLLBACK")
+        raise
+
+# create_all skips tables that already exist, so add newer indexes to existing databases;
+# IF NOT EXISTS keeps workers starting together from racing on the same CREATE INDEX
+with engine.begin() as conn:
+    for index in (ix_users_balance_desc, ix_stocks_price_desc):
+        conn.execute(CreateIndex(index, if_not_exists=True))
+
+# user_version 1: stock prices moved from float dollars to integer cents. The check and
+# the rewrite share one BEGIN IMMEDIATE so workers starting together convert only once
+with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+    conn.exec_driver_sql("BEGIN IMMEDIATE")
+    try:
+        if conn.exec_driver_sql("PRAGMA user_version").scalar() < 1:
+            conn.exec_driver_sql("UPDATE stocks SET price = CAST(ROUND(price * 100) AS INTEGER)")
+            conn.exec_driver_sql("PRAGMA user_version = 1")
+        conn.exec_driver_sql("COMMIT")
+    except Exception:
+        conn.exec_driver_sql("ROLLBACK")
+        raise
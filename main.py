@@ -1,34 +1,96 @@
 from fastapi import FastAPI, Depends, HTTPException
+from sqlalchemy import insert, select, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import Session
-from database import SessionLocal, engine, User, Stock, Transaction, Base
-from pydantic import BaseModel
-from apscheduler.schedulers.background import BackgroundScheduler
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import write_engine, connect_trade_db, SessionLocal, ReadSession, WriteSession, User, Stock, Transaction, Base
+from pydantic import BaseModel, ConfigDict
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+import asyncio
 import random
-import time
+import sqlite3
+from collections import defaultdict
+import numpy as np
 
 app = FastAPI()
 
-# Dependency to get DB session
-def get_db():
-    db = SessionLocal()
-    try:
+# Dependencies to get DB sessions from the reader and writer pools
+async def get_read_db():
+    async with ReadSession() as db:
         yield db
-    finally:
-        db.close()
 
-# Background scheduler to update stock prices every 5 minutes
-scheduler = BackgroundScheduler()
+async def get_write_db():
+    async with WriteSession() as db:
+        yield db
 
-def update_stock_prices():
-    db = SessionLocal()
-    stocks = db.query(Stock).all()
-    for stock in stocks:
-        stock.price = round(random.uniform(1, 100), 2)  # Random price between 1-100
-    db.commit()
-    db.close()
+# Buys, sells and loans skip the ORM and run on one raw connection opened at startup,
+# so every write to users.balance goes through the same connection. The
+# SQL strings are constants so sqlite3's statement cache reuses the prepared
+# statements, and the lock keeps one trade's BEGIN IMMEDIATE ... COMMIT from interleaving
+trade_conn = None
+trade_lock = asyncio.Lock()
+
+SELECT_STOCK_SQL = "SELECT price / 100.0 FROM stocks WHERE id = ?"
+SELECT_USER_SQL = "SELECT 1 FROM users WHERE id = ?"
+DEBIT_BALANCE_SQL = "UPDATE users SET balance = balance - ? WHERE id = ? AND balance >= ? RETURNING balance"
+CREDIT_BALANCE_SQL = "UPDATE users SET balance = balance + ? WHERE id = ? RETURNING balance"
+GRANT_LOAN_SQL = "UPDATE users SET balance = balance + ?, loan_taken = loan_taken + ? WHERE id = ? AND loan_taken + ? <= 100000 RETURNING balance"
+RESERVE_STOCK_SQL = "UPDATE stocks SET available_quantity = available_quantity - ? WHERE id = ? AND available_quantity >= ? RETURNING 1"
+INSERT_TRANSACTION_SQL = "INSERT INTO transactions (user_id, stock_id, quantity, price, type) VALUES (?, ?, ?, ?, ?)"
+
+async def fetch_one(sql: str, params: tuple):
+    async with trade_conn.execute(sql, params) as cursor:
+        return await cursor.fetchone()
+
+async def rollback_trade():
+    # Unlike pooled connections nothing resets trade_conn, so this must run even when
+    # the request is cancelled. aiosqlite runs statements in order, so the ROLLBACK
+    # also undoes a BEGIN that was still in flight; shield keeps a second cancel from
+    # skipping it, and "no transaction is active" just means there was nothing to undo
+    try:
+        await asyncio.shield(trade_conn.execute("ROLLBACK"))
+    except sqlite3.OperationalError:
+        pass
+
+# Background scheduler to update stock prices every 5 minutes, running on the
+# app's event loop alongside the request handlers
+scheduler = AsyncIOScheduler()
+
+async def update_stock_prices():
+    # BEGIN IMMEDIATE takes the write lock up front instead of upgrading a deferred
+    # transaction mid-way, which concurrent trade commits could make fail with SQLITE_BUSY
+    async with write_engine.connect() as conn:
+        await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.exec_driver_sql("BEGIN IMMEDIATE")
+        try:
+            ids = (await conn.execute(select(Stock.id))).scalars().all()
+            if ids:
+                # Draw the whole batch of random prices between 1.00-100.00, as cents, in one call
+                prices = np.random.randint(100, 10001, size=len(ids)).tolist()
+                await conn.exec_driver_sql("UPDATE stocks SET price = ? WHERE id = ?", list(zip(prices, ids)))
+            await conn.exec_driver_sql("COMMIT")
+        except Exception:
+            await conn.exec_driver_sql("ROLLBACK")
+            raise
 
 scheduler.add_job(update_stock_prices, "interval", minutes=1)
-scheduler.start()
+
+@app.on_event("startup")
+async def start_scheduler():
+    scheduler.start()
+
+@app.on_event("shutdown")
+async def stop_scheduler():
+    scheduler.shutdown()
+
+@app.on_event("startup")
+async def open_trade_db():
+    global trade_conn
+    trade_conn = await connect_trade_db()
+
+@app.on_event("shutdown")
+async def close_trade_db():
+    await trade_conn.close()
 
 # Pydantic model for stock registration
 class StockCreate(BaseModel):
@@ -39,160 +101,231 @@ class StockCreate(BaseModel):
 class UserCreate(BaseModel):
     name: str
 
+# Response models read plain column rows instead of ORM instances
+class StockOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+    id: int
+    name: str
+    price: float
+    available_quantity: int
+
+class UserOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+    id: int
+    name: str
+    balance: float
+    loan_taken: float
+
+class StockList(BaseModel):
+    stocks: list[StockOut]
+
+class UserList(BaseModel):
+    users: list[UserOut]
+
+class TopStocks(BaseModel):
+    top_stocks: list[StockOut]
+
+class TopUsers(BaseModel):
+    top_users: list[UserOut]
+
+STOCK_COLUMNS = (Stock.id, Stock.name, (Stock.price / 100.0).label("price"), Stock.available_quantity)
+USER_COLUMNS = (User.id, User.name, User.balance, User.loan_taken)
+
 @app.post("/users/register")
-def register_user(user: UserCreate, db: Session = Depends(get_db)):
-    existing_user = db.query(User).filter(User.name == user.name).first()
-    if existing_user:
+async def register_user(user: UserCreate, db: AsyncSession = Depends(get_write_db)):
+    # ON CONFLICT DO NOTHING lets the unique name index reject duplicates in the same
+    # statement, and RETURNING reads the new row back without a refresh() SELECT
+    new_user = (await db.execute(
+        sqlite_insert(User)
+        .values(name=user.name, balance=100000, loan_taken=0)
+        .on_conflict_do_nothing(index_elements=["name"])
+        .returning(*USER_COLUMNS)
+    )).one_or_none()
+    if new_user is None:
         raise HTTPException(status_code=400, detail="User already exists")
 
-    new_user = User(name=user.name, balance=100000, loan_taken=0)
-    db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
-    return {"message": "User registered successfully", "user": new_user}
+    await db.commit()
+    return {"message": "User registered successfully", "user": UserOut.model_validate(new_user)}
 
 
 @app.post("/stocks/register")
-def register_stock(stock: StockCreate, db: Session = Depends(get_db)):
-    existing_stock = db.query(Stock).filter(Stock.name == stock.name).first()
-    if existing_stock:
+async def register_stock(stock: StockCreate, db: AsyncSession = Depends(get_write_db)):
+    new_stock = (await db.execute(
+        sqlite_insert(Stock)
+        .values(name=stock.name, price=round(stock.price * 100), available_quantity=stock.available_quantity)
+        .on_conflict_do_nothing(index_elements=["name"])
+        .returning(*STOCK_COLUMNS)
+    )).one_or_none()
+    if new_stock is None:
         raise HTTPException(status_code=400, detail="Stock already exists")
 
-    new_stock = Stock(name=stock.name, price=stock.price, available_quantity=stock.available_quantity)
-    db.add(new_stock)
-    db.commit()
-    db.refresh(new_stock)
-    return {"message": "Stock registered successfully", "stock": new_stock}
+    await db.commit()
+    return {"message": "Stock registered successfully", "stock": StockOut.model_validate(new_stock)}
 
-@app.get("/stocks/history")
-def get_stock_history(db: Session = Depends(get_db)):
-    stocks = db.query(Stock).all()
+@app.get("/stocks/history", response_model=StockList)
+async def get_stock_history(db: AsyncSession = Depends(get_read_db)):
+    stocks = (await db.execute(select(*STOCK_COLUMNS))).all()
     return {"stocks": stocks}
 class LoanRequest(BaseModel):
     user_id: int
     amount: float
 
 @app.post("/users/loan")
-def take_loan(loan: LoanRequest, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == loan.user_id).first()
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    if user.loan_taken + loan.amount > 100000:
-        raise HTTPException(status_code=400, detail="Loan limit exceeded (Max: 100000)")
-
-    user.balance += loan.amount
-    user.loan_taken += loan.amount
-    db.commit()
-    return {"message": "Loan approved", "new_balance": user.balance}
+async def take_loan(loan: LoanRequest):
+    # A single UPDATE checks the limit and credits the balance atomically; the lock keeps
+    # it from landing inside another request's open trade transaction
+    async with trade_lock:
+        user = await fetch_one(GRANT_LOAN_SQL, (loan.amount, loan.amount, loan.user_id, loan.amount))
+        if not user:
+            if not await fetch_one(SELECT_USER_SQL, (loan.user_id,)):
+                raise HTTPException(status_code=404, detail="User not found")
+            raise HTTPException(status_code=400, detail="Loan limit exceeded (Max: 100000)")
+    return {"message": "Loan approved", "new_balance": float(user[0])}
 class TradeRequest(BaseModel):
     user_id: int
     stock_id: int
     quantity: int
 
 @app.post("/users/buy")
-def buy_stock(trade: TradeRequest, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == trade.user_id).first()
-    stock = db.query(Stock).filter(Stock.id == trade.stock_id).first()
-
-    if not user or not stock:
-        raise HTTPException(status_code=404, detail="User or Stock not found")
-    
-    total_cost = trade.quantity * stock.price
-    if user.balance < total_cost:
-        raise HTTPException(status_code=400, detail="Insufficient balance")
-
-    if stock.available_quantity < trade.quantity:
-        raise HTTPException(status_code=400, detail="Not enough stock available")
-
-    # Deduct balance, reduce stock quantity, and record transaction
-    user.balance -= total_cost
-    stock.available_quantity -= trade.quantity
-    new_transaction = Transaction(user_id=user.id, stock_id=stock.id, quantity=trade.quantity, price=stock.price, type="buy")
-
-    db.add(new_transaction)
-    db.commit()
-    return {"message": "Stock purchased", "new_balance": user.balance}
+async def buy_stock(trade: TradeRequest):
+    # Take the write lock up front; the conditional UPDATEs below check balance and
+    # quantity in the same statement that spends them, so concurrent buyers can't overspend
+    async with trade_lock:
+        try:
+            await trade_conn.execute("BEGIN IMMEDIATE")
+            stock = await fetch_one(SELECT_STOCK_SQL, (trade.stock_id,))
+            if not stock:
+                raise HTTPException(status_code=404, detail="User or Stock not found")
+            price = stock[0]
+            total_cost = trade.quantity * price
+
+            # Deduct balance, reduce stock quantity, and record transaction
+            user = await fetch_one(DEBIT_BALANCE_SQL, (total_cost, trade.user_id, total_cost))
+            if not user:
+                if not await fetch_one(SELECT_USER_SQL, (trade.user_id,)):
+                    raise HTTPException(status_code=404, detail="User or Stock not found")
+                raise HTTPException(status_code=400, detail="Insufficient balance")
+
+            if not await fetch_one(RESERVE_STOCK_SQL, (trade.quantity, trade.stock_id, trade.quantity)):
+                raise HTTPException(status_code=400, detail="Not enough stock available")
+
+            await trade_conn.execute(INSERT_TRANSACTION_SQL, (trade.user_id, trade.stock_id, trade.quantity, price, "buy"))
+            await trade_conn.execute("COMMIT")
+        except BaseException:
+            await rollback_trade()
+            raise
+    return {"message": "Stock purchased", "new_balance": float(user[0])}
 
 @app.post("/users/sell")
-def sell_stock(trade: TradeRequest, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == trade.user_id).first()
-    stock = db.query(Stock).filter(Stock.id == trade.stock_id).first()
-
-    if not user or not stock:
-        raise HTTPException(status_code=404, detail="User or Stock not found")
-
-    total_sale = trade.quantity * stock.price
-    user.balance += total_sale
-
-    new_transaction = Transaction(user_id=user.id, stock_id=stock.id, quantity=trade.quantity, price=stock.price, type="sell")
-
-    db.add(new_transaction)
-    db.commit()
-    return {"message": "Stock sold", "new_balance": user.balance}
-@app.get("/users/report")
-def user_report(db: Session = Depends(get_db)):
-    users = db.query(User).all()
+async def sell_stock(trade: TradeRequest):
+    async with trade_lock:
+        try:
+            await trade_conn.execute("BEGIN IMMEDIATE")
+            stock = await fetch_one(SELECT_STOCK_SQL, (trade.stock_id,))
+            if not stock:
+                raise HTTPException(status_code=404, detail="User or Stock not found")
+            price = stock[0]
+
+            total_sale = trade.quantity * price
+            user = await fetch_one(CREDIT_BALANCE_SQL, (total_sale, trade.user_id))
+            if not user:
+                raise HTTPException(status_code=404, detail="User or Stock not found")
+
+            await trade_conn.execute(INSERT_TRANSACTION_SQL, (trade.user_id, trade.stock_id, trade.quantity, price, "sell"))
+            await trade_conn.execute("COMMIT")
+        except BaseException:
+            await rollback_trade()
+            raise
+    return {"message": "Stock sold", "new_balance": float(user[0])}
+@app.get("/users/report", response_model=UserList)
+async def user_report(db: AsyncSession = Depends(get_read_db)):
+    users = (await db.execute(select(*USER_COLUMNS))).all()
     return {"users": users}
 
-@app.get("/stocks/report")
-def stock_report(db: Session = Depends(get_db)):
-    stocks = db.query(Stock).all()
+@app.get("/stocks/report", response_model=StockList)
+async def stock_report(db: AsyncSession = Depends(get_read_db)):
+    stocks = (await db.execute(select(*STOCK_COLUMNS))).all()
     return {"stocks": stocks}
 
-@app.get("/users/top")
-def top_users(db: Session = Depends(get_db)):
-    users = db.query(User).order_by(User.balance.desc()).limit(5).all()
+@app.get("/users/top", response_model=TopUsers)
+async def top_users(db: AsyncSession = Depends(get_read_db)):
+    users = (await db.execute(select(*USER_COLUMNS).order_by(User.balance.desc()).limit(5))).all()
     return {"top_users": users}
 
-@app.get("/stocks/top")
-def top_stocks(db: Session = Depends(get_db)):
-    stocks = db.query(Stock).order_by(Stock.price.desc()).limit(5).all()
+@app.get("/stocks/top", response_model=TopStocks)
+async def top_stocks(db: AsyncSession = Depends(get_read_db)):
+    stocks = (await db.execute(select(*STOCK_COLUMNS).order_by(Stock.price.desc()).limit(5))).all()
     return {"top_stocks": stocks}
 
 
+CREDIT_USER_SQL = text("UPDATE users SET balance = balance + :delta WHERE id = :id")
+ADJUST_STOCK_SQL = text("UPDATE stocks SET available_quantity = available_quantity + :delta WHERE id = :id")
+
+def load_trading_snapshot(db: Session):
+    users = db.execute(select(User.id, User.name, User.balance)).all()
+    stocks = db.execute(select(Stock.id, Stock.name, Stock.price, Stock.available_quantity)).all()
+    balance_by_user = {user.id: user.balance for user in users}
+    qty_by_stock = {stock.id: stock.available_quantity for stock in stocks}
+    return users, stocks, balance_by_user, qty_by_stock
+
+def flush_simulated_trades(db: Session, pending: list, balance_delta: dict, qty_delta: dict):
+    # Apply the batch as deltas so rows changed by anyone else since the snapshot stay correct
+    if not pending:
+        return
+    db.execute(insert(Transaction), pending)
+    db.execute(CREDIT_USER_SQL, [{"id": user_id, "delta": delta} for user_id, delta in balance_delta.items()])
+    db.execute(ADJUST_STOCK_SQL, [{"id": stock_id, "delta": delta} for stock_id, delta in qty_delta.items()])
+    db.commit()
+
 def simulate_random_trading():
     db: Session = SessionLocal()
     transaction_count = 0  # Counter for transactions
+    pending = []  # Transaction rows not yet written
+    balance_delta = defaultdict(float)  # Unwritten balance change per user
+    qty_delta = defaultdict(int)  # Unwritten quantity change per stock
 
-    while transaction_count < 10:  # Run 100 transactions
-        users = db.query(User).all()
-        stocks = db.query(Stock).all()
+    # Track balances and quantities locally instead of re-reading both tables every trade
+    users, stocks, balance_by_user, qty_by_stock = load_trading_snapshot(db)
 
-        if not users or not stocks:
-            print("No users or stocks found in the database!")
-            break
+    if not users or not stocks:
+        print("No users or stocks found in the database!")
+        db.close()
+        return
 
+    while transaction_count < 10:  # Run 100 transactions
         user = random.choice(users)  # Pick a random user
         stock = random.choice(stocks)  # Pick a random stock
         quantity = random.randint(1, 10)  # Pick a random quantity (1 to 10)
         action = random.choice(["buy", "sell"])  # Randomly decide action
+        price = stock.price / 100  # Stored in cents
 
         if action == "buy":
-            total_cost = stock.price * quantity
-            if user.balance >= total_cost and stock.available_quantity >= quantity:
-                user.balance -= total_cost
-                stock.available_quantity -= quantity
-                new_transaction = Transaction(
-                    user_id=user.id, stock_id=stock.id, quantity=quantity, price=stock.price, type="buy"
+            total_cost = price * quantity
+            if balance_by_user[user.id] >= total_cost and qty_by_stock[stock.id] >= quantity:
+                balance_by_user[user.id] -= total_cost
+                balance_delta[user.id] -= total_cost
+                qty_by_stock[stock.id] -= quantity
+                qty_delta[stock.id] -= quantity
+                pending.append(
+                    {"user_id": user.id, "stock_id": stock.id, "quantity": quantity, "price": price, "type": "buy"}
                 )
-                db.add(new_transaction)
-                db.commit()
-                print(f"Transaction {transaction_count+1}: {user.name} bought {quantity} of {stock.name} at {stock.price}")
+                print(f"Transaction {transaction_count+1}: {user.name} bought {quantity} of {stock.name} at {price}")
 
         elif action == "sell":
-            total_sale = stock.price * quantity
-            user.balance += total_sale
-            stock.available_quantity += quantity
-            new_transaction = Transaction(
-                user_id=user.id, stock_id=stock.id, quantity=quantity, price=stock.price, type="sell"
+            total_sale = price * quantity
+            balance_by_user[user.id] += total_sale
+            balance_delta[user.id] += total_sale
+            qty_by_stock[stock.id] += quantity
+            qty_delta[stock.id] += quantity
+            pending.append(
+                {"user_id": user.id, "stock_id": stock.id, "quantity": quantity, "price": price, "type": "sell"}
             )
-            db.add(new_transaction)
-            db.commit()
-            print(f"Transaction {transaction_count+1}: {user.name} sold {quantity} of {stock.name} at {stock.price}")
+            print(f"Transaction {transaction_count+1}: {user.name} sold {quantity} of {stock.name} at {price}")
 
         transaction_count += 1
-        time.sleep(1)  # Add a small delay for better simulation
+
+    # The run is short, so all trades and balance/quantity changes go out in one commit
+    flush_simulated_trades(db, pending, balance_delta, qty_delta)
 
     db.close()
     print("100 Random Trades Completed!")